@@ -8,6 +8,9 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.twofactor.totp import TOTP
 from cryptography.hazmat.primitives.hashes import SHA1
 
+_DEFAULT_BACKEND = default_backend()
+_SHA1 = SHA1()
+
 
 def generate_totp_passcode(secret):
     """Generate TOTP passcode.
@@ -22,5 +25,5 @@ def generate_totp_passcode(secret):
 
     decoded = base64.b32decode(secret)
     totp = TOTP(
-        decoded, 6, SHA1(), 30, backend=default_backend())
+        decoded, 6, _SHA1, 30, backend=_DEFAULT_BACKEND)
     return totp.generate(timegm(datetime.utcnow().utctimetuple())).decode()
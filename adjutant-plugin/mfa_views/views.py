@@ -33,6 +33,9 @@ from adjutant.api.v1.tasks import TaskView
 from adjutant.api.v1.utils import add_task_id_for_roles
 from adjutant.common import user_store
 
+_DEFAULT_BACKEND = default_backend()
+_SHA1 = SHA1()
+
 
 class EditMFA(TaskView):
     """
@@ -141,7 +144,7 @@ class EditMFA(TaskView):
 
         decoded = base64.b32decode(secret)
 
-        totp = TOTP(decoded, 6, SHA1(), 30, backend=default_backend())
+        totp = TOTP(decoded, 6, _SHA1, 30, backend=_DEFAULT_BACKEND)
 
         cloud_name = class_conf.get('cloud_name')
         return totp.get_provisioning_uri(user_name, cloud_name)
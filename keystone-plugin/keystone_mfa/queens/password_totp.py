@@ -27,8 +27,6 @@ function to generate a one-time password. The timestamp typically increases in
 same secret key will be equal.
 """
 
-from oslo_log import log
-
 from keystone.auth import plugins
 from keystone.auth.plugins import base
 from keystone.common import provider_api
@@ -39,7 +37,6 @@ from keystone_mfa import utils
 
 METHOD_NAME = 'password'
 
-LOG = log.getLogger(__name__)
 PROVIDERS = provider_api.ProviderAPIs
 
 
@@ -75,19 +72,9 @@ class PasswordTOTP(base.AuthMethodHandler):
             msg = _('Invalid username or password')
             raise exception.Unauthorized(msg)
 
-        for credential in credentials:
-            try:
-                generated_passcodes = utils._generate_totp_passcodes(
-                    credential['blob'])
-                if auth_passcode in generated_passcodes:
-                    valid_passcode = True
-                    break
-            except (ValueError, KeyError):
-                LOG.debug('No TOTP match; credential id: %s, user_id: %s',
-                          credential['id'], user_info.user_id)
-            except (TypeError):
-                LOG.debug('Base32 decode failed for TOTP credential %s',
-                          credential['id'])
+        if credentials:
+            valid_passcode = utils._verify_passcode(
+                auth_passcode, credentials, user_info.user_id)
 
         if not valid_passcode:
             # authentication failed because of invalid passcode
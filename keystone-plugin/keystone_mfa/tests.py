@@ -0,0 +1,243 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import base64
+import hashlib
+import hmac
+import unittest
+from unittest import mock
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.hashes import SHA1
+from cryptography.hazmat.primitives.twofactor.totp import TOTP
+
+from keystone import conf
+from keystone import exception
+
+from keystone_mfa.queens import password_totp
+from keystone_mfa import utils
+
+SECRET = 'GEZDGNBVGY3TQOJQGEZDGNBVGY3TQOJQ'
+TIMESTAMP = 1234567890.5
+
+
+def setUpModule():
+    # keystone's exceptions read their config options when raised.
+    conf.configure()
+
+
+def _crypto_passcode(secret, timestamp):
+    totp = TOTP(base64.b32decode(secret), 6, SHA1(), 30,
+                backend=default_backend())
+    return totp.generate(timestamp).decode('utf-8')
+
+
+class KeystoneMFATestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(KeystoneMFATestCase, self).setUp()
+        utils._hmac_cache.clear()
+
+        # NOTE: patches the time module as seen by utils only, so nothing
+        # else in the process has its clock frozen.
+        patcher = mock.patch.object(utils, 'time')
+        self.time = patcher.start().time
+        self.time.return_value = TIMESTAMP
+        self.addCleanup(patcher.stop)
+
+
+class TOTPUtilsTests(KeystoneMFATestCase):
+
+    def test_hotp_rfc4226_vectors(self):
+        """
+        The HOTP values from RFC 4226 Appendix D.
+        """
+        expected = [755224, 287082, 359152, 969429, 338314,
+                    254676, 287922, 162583, 399871, 520489]
+        keyed_hmac = hmac.new(b'12345678901234567890',
+                              digestmod=hashlib.sha1)
+
+        for counter, passcode in enumerate(expected):
+            self.assertEqual(
+                passcode, utils._hotp_value(keyed_hmac, counter))
+
+    def test_passcodes_match_cryptography(self):
+        """
+        Current and previous window passcodes match cryptography's TOTP.
+        """
+        credentials = [{'id': 'cred', 'blob': SECRET}]
+
+        windows = list(utils._iter_valid_passcodes(credentials, 'user'))
+
+        self.assertEqual(
+            [[int(_crypto_passcode(SECRET, TIMESTAMP))],
+             [int(_crypto_passcode(SECRET, TIMESTAMP - 30))]],
+            windows)
+
+    def test_verify_passcode(self):
+        """
+        Current and previous window passcodes are accepted, older are not.
+        """
+        credentials = [{'id': 'cred', 'blob': SECRET}]
+
+        for timestamp in (TIMESTAMP, TIMESTAMP - 30):
+            self.assertTrue(utils._verify_passcode(
+                _crypto_passcode(SECRET, timestamp), credentials, 'user'))
+        self.assertFalse(utils._verify_passcode(
+            _crypto_passcode(SECRET, TIMESTAMP - 60), credentials, 'user'))
+
+    def test_verify_passcode_malformed(self):
+        """
+        Passcodes that aren't six ascii digits are rejected.
+        """
+        credentials = [{'id': 'cred', 'blob': SECRET}]
+
+        for passcode in ('12345', '1234567', '12a456', ' 12345', u'١٢٣٤٥٦'):
+            self.assertFalse(
+                utils._verify_passcode(passcode, credentials, 'user'))
+
+    def test_verify_passcode_skips_bad_blobs(self):
+        """
+        Credentials with bad secrets are skipped rather than raising.
+        """
+        bad_credentials = [
+            {'id': 'not-base32', 'blob': '!!!notbase32'},
+            {'id': 'too-short', 'blob': SECRET[:16]},
+            {'id': 'non-ascii', 'blob': u'\xe9' * 32},
+            {'id': 'none', 'blob': None},
+            {'id': 'int', 'blob': 5},
+            {'id': 'missing'},
+        ]
+        passcode = _crypto_passcode(SECRET, TIMESTAMP)
+
+        self.assertFalse(
+            utils._verify_passcode(passcode, bad_credentials, 'user'))
+        self.assertTrue(utils._verify_passcode(
+            passcode, bad_credentials + [{'id': 'cred', 'blob': SECRET}],
+            'user'))
+
+    @mock.patch.object(utils, 'hmac', wraps=hmac)
+    @mock.patch.object(utils, '_hotp_value', wraps=utils._hotp_value)
+    def test_verify_passcode_padding(self, mock_hotp, mock_hmac):
+        """
+        Each window costs TOTP_SLOT_BUDGET HMACs and comparisons.
+        """
+        credentials = [{'id': 'cred', 'blob': SECRET}]
+
+        self.assertTrue(utils._verify_passcode(
+            _crypto_passcode(SECRET, TIMESTAMP), credentials, 'user'))
+        self.assertEqual(utils.TOTP_SLOT_BUDGET, mock_hotp.call_count)
+        self.assertEqual(utils.TOTP_SLOT_BUDGET,
+                         mock_hmac.compare_digest.call_count)
+
+        mock_hotp.reset_mock()
+        mock_hmac.compare_digest.reset_mock()
+        self.assertFalse(utils._verify_passcode(
+            _crypto_passcode(SECRET, TIMESTAMP - 60), credentials, 'user'))
+        self.assertEqual(2 * utils.TOTP_SLOT_BUDGET, mock_hotp.call_count)
+        self.assertEqual(2 * utils.TOTP_SLOT_BUDGET,
+                         mock_hmac.compare_digest.call_count)
+
+
+class PasswordTOTPTests(KeystoneMFATestCase):
+
+    def setUp(self):
+        super(PasswordTOTPTests, self).setUp()
+        patcher = mock.patch.object(password_totp, 'PROVIDERS')
+        self.providers = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.credentials = [{'id': 'cred', 'blob': SECRET}]
+        self.providers.credential_api.list_credentials_for_user.side_effect = (
+            lambda user_id, type=None: list(self.credentials))
+        self.providers.identity_api.authenticate.side_effect = (
+            self._check_password)
+
+        patcher = mock.patch.object(
+            password_totp.plugins.UserAuthInfo, 'create')
+        self.user_info = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.user_info.user_id = 'user'
+
+    def _check_password(self, request, user_id, password):
+        if password != 'password':
+            raise AssertionError('Invalid user / password')
+
+    def authenticate(self, password):
+        self.user_info.password = password
+        return password_totp.PasswordTOTP().authenticate(mock.Mock(), {})
+
+    def test_authenticate(self):
+        """
+        The passcode is split from the password and checked.
+        """
+        response = self.authenticate(
+            'password' + _crypto_passcode(SECRET, TIMESTAMP))
+
+        self.assertTrue(response.status)
+        self.assertEqual({'user_id': 'user'}, response.response_data)
+        self.providers.identity_api.authenticate.assert_called_once_with(
+            mock.ANY, user_id='user', password='password')
+
+    def test_authenticate_no_credentials(self):
+        """
+        Users without TOTP credentials authenticate with just a password.
+        """
+        self.credentials = []
+
+        response = self.authenticate('password')
+
+        self.assertTrue(response.status)
+        self.providers.identity_api.authenticate.assert_called_once_with(
+            mock.ANY, user_id='user', password='password')
+
+    def test_authenticate_invalid_passcode(self):
+        """
+        A wrong passcode is rejected after the password is checked.
+        """
+        passcode = _crypto_passcode(SECRET, TIMESTAMP - 60)
+
+        self.assertRaises(exception.Unauthorized,
+                          self.authenticate, 'password' + passcode)
+        self.providers.identity_api.authenticate.assert_called_once_with(
+            mock.ANY, user_id='user', password='password')
+
+    def test_authenticate_invalid_password(self):
+        """
+        A wrong password is rejected even with a valid passcode.
+        """
+        self.assertRaises(
+            exception.Unauthorized, self.authenticate,
+            'wrong' + _crypto_passcode(SECRET, TIMESTAMP))
+
+    def test_authenticate_credential_changes(self):
+        """
+        Credentials are read on every authentication, never cached here.
+
+        Caching, and its invalidation on create, update and delete, is left
+        to keystone's credential manager, so a deleted credential stops
+        working on the next authentication however often the user logs in.
+        """
+        list_credentials = (
+            self.providers.credential_api.list_credentials_for_user)
+
+        for offset in (0, 20, 40):
+            self.time.return_value = TIMESTAMP + offset
+            self.authenticate(
+                'password' + _crypto_passcode(SECRET, TIMESTAMP + offset))
+        self.assertEqual(3, list_credentials.call_count)
+
+        self.credentials = []
+        self.assertRaises(
+            exception.Unauthorized, self.authenticate,
+            'password' + _crypto_passcode(SECRET, TIMESTAMP + 40))
+        self.assertEqual(4, list_credentials.call_count)
+        list_credentials.assert_called_with('user', type='totp')
@@ -11,48 +11,187 @@
 # under the License.
 
 import base64
+import hashlib
+import hmac
+import string
+import struct
+import time
 
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.twofactor import totp as crypto_totp
-from oslo_utils import timeutils
-import six
+from oslo_log import log
+
+LOG = log.getLogger(__name__)
 
 PASSCODE_LENGTH = 6
 PASSCODE_TIME_PERIOD = 30
 
+_PASSCODE_MODULUS = 10 ** PASSCODE_LENGTH
+
+# Shortest decoded secret we accept, in bytes. This is the same 128 bit
+# minimum that cryptography's HOTP implementation enforces.
+MIN_KEY_LENGTH = 16
+
+# Each window's passcodes are padded out to this many HMACs and comparisons
+# so the time taken doesn't reveal how many credentials a user has. Users
+# with more credentials than this are still checked against all of them.
+TOTP_SLOT_BUDGET = 8
+
+# Maximum number of keyed HMAC instances kept in _hmac_cache.
+HMAC_CACHE_SIZE = 4096
+
+_hmac_cache = {}
 
-def _generate_totp_passcodes(secret, included_previous_windows=1):
-    """Generate TOTP passcode.
 
-    :param bytes secret: A base32 encoded secret for the TOTP authentication
-    :returns: totp passcode as bytes
+def _get_hmac(secret):
+    """Get a keyed HMAC-SHA1 instance for a secret.
+
+    Decoding the secret and keying the HMAC is the same work on every
+    authentication, so the keyed instance is cached against the secret
+    exactly as it is stored. Callers must copy() it before use. The cache is
+    simply emptied once it reaches HMAC_CACHE_SIZE.
+
+    :param secret: A base32 encoded secret for the TOTP authentication
+    :type secret: str or bytes
+    :returns: an hmac.HMAC instance keyed with the decoded secret
     """
-    if isinstance(secret, six.text_type):
+    keyed_hmac = _hmac_cache.get(secret)
+    if keyed_hmac is not None:
+        return keyed_hmac
+
+    padded = secret
+    if isinstance(padded, str):
         # NOTE(dstanek): since this may be coming from the JSON stored in the
         # database it may be UTF-8 encoded
-        secret = secret.encode('utf-8')
+        # A valid base32 secret is always plain ascii.
+        padded = padded.encode('ascii')
 
     # NOTE(nonameentername): cryptography takes a non base32 encoded value for
     # TOTP. Add the correct padding to be able to base32 decode
-    while len(secret) % 8 != 0:
-        secret = secret + b'='
+    padded += b'=' * (-len(padded) % 8)
+
+    key = base64.b32decode(padded)
+    if len(key) < MIN_KEY_LENGTH:
+        raise ValueError('Key length has to be at least 128 bits.')
 
-    decoded = base64.b32decode(secret)
     # NOTE(lhinds) This is marked as #nosec since bandit will see SHA1
     # which is marked as insecure. In this instance however, keystone uses
     # HMAC-SHA1 when generating the TOTP, which is currently not insecure but
     # will still trigger when scanned by bandit.
-    totp = crypto_totp.TOTP(
-        decoded, PASSCODE_LENGTH, hashes.SHA1(), PASSCODE_TIME_PERIOD,  # nosec
-        backend=default_backend())
-
-    passcode_ts = timeutils.utcnow_ts(microsecond=True)
-    passcodes = [totp.generate(passcode_ts).decode('utf-8')]
-
-    for i in range(included_previous_windows):
-        # NOTE(adriant): we move back the timestamp the number of seconds in
-        # PASSCODE_TIME_PERIOD each time.
-        passcode_ts -= PASSCODE_TIME_PERIOD
-        passcodes.append(totp.generate(passcode_ts).decode('utf-8'))
-    return passcodes
+    keyed_hmac = hmac.new(key, digestmod=hashlib.sha1)  # nosec
+
+    if len(_hmac_cache) >= HMAC_CACHE_SIZE:
+        _hmac_cache.clear()
+    _hmac_cache[secret] = keyed_hmac
+    return keyed_hmac
+
+
+# Keyed HMAC used for the padding described at TOTP_SLOT_BUDGET. See
+# _get_hmac for why SHA1 is marked #nosec.
+_dummy_hmac = hmac.new(b'\0' * MIN_KEY_LENGTH, digestmod=hashlib.sha1)  # nosec
+
+
+def _hotp_value(keyed_hmac, counter):
+    """Generate a HOTP passcode as defined in RFC 4226, as an int.
+
+    :param keyed_hmac: An HMAC-SHA1 instance keyed with the decoded secret,
+        which is copied rather than updated
+    :param int counter: The moving factor, for TOTP the time window
+    :returns: the passcode as an int
+    """
+    # NOTE: copying the keyed instance reuses the already hashed inner and
+    # outer key pads, so only the counter itself is hashed here.
+    mac = keyed_hmac.copy()
+    mac.update(struct.pack('>Q', counter))
+    digest = mac.digest()
+    offset = digest[-1] & 0x0f
+    value = struct.unpack_from('>I', digest, offset)[0] & 0x7fffffff
+    return value % _PASSCODE_MODULUS
+
+
+def _iter_valid_passcodes(credentials, user_id, included_previous_windows=1):
+    """Generate the valid passcodes for a set of credentials, by window.
+
+    Yields a list with every credential's passcode for the current window,
+    then one list for each previous window, so a caller can stop as soon as
+    a window matches. Credentials with a bad secret are logged and skipped.
+
+    :param list credentials: The user's totp credentials
+    :param str user_id: The id of the user, for logging
+    :returns: a generator of lists of passcodes as ints, newest window first
+    """
+    keyed_hmacs = []
+    for credential in credentials:
+        try:
+            keyed_hmacs.append(_get_hmac(credential['blob']))
+        except (ValueError, KeyError):
+            LOG.debug('No TOTP match; credential id: %s, user_id: %s',
+                      credential['id'], user_id)
+        except (TypeError):
+            LOG.debug('Base32 decode failed for TOTP credential %s',
+                      credential['id'])
+
+    padding = max(0, TOTP_SLOT_BUDGET - len(keyed_hmacs))
+    counter = int(time.time() / PASSCODE_TIME_PERIOD)
+    for window in range(included_previous_windows + 1):
+        passcodes = [_hotp_value(keyed_hmac, counter - window)
+                     for keyed_hmac in keyed_hmacs]
+        # NOTE: the padding passcodes are thrown away, never matched against,
+        # as the dummy key is public.
+        for _ in range(padding):
+            _hotp_value(_dummy_hmac, counter - window)
+        yield passcodes
+
+
+def _verify_passcode(passcode, credentials, user_id):
+    """Check a passcode against a user's totp credentials.
+
+    Previous windows are only generated if the current window doesn't match,
+    which saves work when the clocks agree. Each window is still compared in
+    full with _passcode_in, so the time taken only reveals which window
+    matched, and never which credential.
+
+    :param str passcode: The passcode supplied by the user
+    :param list credentials: The user's totp credentials
+    :param str user_id: The id of the user, for logging
+    :returns: True if passcode is valid for any of the credentials
+    """
+    if not _is_wellformed_passcode(passcode):
+        return False
+    passcode = int(passcode)
+
+    for passcodes in _iter_valid_passcodes(credentials, user_id):
+        padding = max(0, TOTP_SLOT_BUDGET - len(passcodes))
+        if _passcode_in(passcode, passcodes, padding=padding):
+            return True
+    return False
+
+
+def _is_wellformed_passcode(passcode):
+    """Check a passcode could be valid before generating any passcodes.
+
+    :param str passcode: The passcode supplied by the user
+    :returns: True if passcode is PASSCODE_LENGTH ascii digits
+    """
+    if len(passcode) != PASSCODE_LENGTH:
+        return False
+    return all(char in string.digits for char in passcode)
+
+
+def _passcode_in(passcode, passcodes, padding=0):
+    """Check if passcode is one of passcodes in constant time.
+
+    Every candidate is compared with hmac.compare_digest and there is no early
+    exit, so the time taken doesn't reveal if or where a match occurred.
+
+    :param int passcode: The passcode supplied by the user
+    :param list passcodes: The valid passcodes to check against, as ints
+    :param int padding: Number of extra comparisons to make whose result is
+        ignored
+    :returns: True if passcode matches any of passcodes
+    """
+    passcode = passcode.to_bytes(4, 'big')
+    matched = False
+    for candidate in passcodes:
+        matched |= hmac.compare_digest(passcode, candidate.to_bytes(4, 'big'))
+    for _ in range(padding):
+        hmac.compare_digest(passcode, (0).to_bytes(4, 'big'))
+    return matched
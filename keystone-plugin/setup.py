@@ -32,9 +32,9 @@ setup(
         'Intended Audience :: System Administrators',
         'License :: OSI Approved :: Apache Software License',
         'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 2.7',
     ],
     keywords='keystone auth mfa totp openstack',
+    python_requires='>=3.5',
     packages=find_packages(),
     entry_points={
         'keystone.auth.password': [